@@ -1,12 +1,18 @@
+import functools
+import gzip
+import io
 import json
 import logging
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
+import requests
 import sqlalchemy as sql
 from google.cloud import storage
-from google.cloud import bigquery
 from google.cloud import exceptions as GCPExceptions
 from google.auth import exceptions as GAuthExceptions
 
@@ -23,9 +29,12 @@ logging.basicConfig(
 def makeDBConnection(dbParams):
 
     try:
-        connectString = f'mysql+pymysql://{dbParams["USER"]}:{dbParams["PASSWORD"]}@{dbParams["HOST"]}:{dbParams["PORT"]}/{dbParams["NAME"]}'
-        engine = sql.create_engine(connectString)
-        engine.connect()
+        connectString = f'mysql+mysqldb://{dbParams["USER"]}:{dbParams["PASSWORD"]}@{dbParams["HOST"]}:{dbParams["PORT"]}/{dbParams["NAME"]}?charset=utf8mb4'
+        engine = sql.create_engine(connectString, pool_size=10, max_overflow=20,
+                                   pool_pre_ping=True, pool_recycle=1800,
+                                   pool_timeout=30)
+        # Return the validation connection to the pool for the queries to reuse.
+        engine.connect().close()
         logging.info('DB connection established and validated.')
         return engine
 
@@ -35,22 +44,31 @@ def makeDBConnection(dbParams):
         sys.exit('Exiting due to failed DB connection.')
 
 
-def makeGCPConnection(gcpParams, targetBucketName):
+def makeGCPConnection(gcpParams, targetBucketName, uploadWorkers):
 
     try:
         client = storage.Client.from_service_account_info(gcpParams)
+
+        # All uploads share the client's session. Its default pool only keeps
+        # 10 connections per host, so with more upload workers the extra
+        # connections would be dropped and TLS handshakes repeated.
+        if not client._http.is_mtls:
+            client._http.mount('https://', requests.adapters.HTTPAdapter(
+                pool_maxsize=uploadWorkers))
+
         bucket = client.bucket(targetBucketName)
-        if not bucket.exists():
-            logging.error(
-                f'Bucket {targetBucketName} in {client.project} not found.')
-            sys.exit('Exiting due to invalid bucket name.')
-        else:
-            logging.info(
-                f'Bucket {targetBucketName} found in {client.project}.')
+        bucket.reload()
+        logging.info(
+            f'Bucket {targetBucketName} found in {client.project}.')
 
         logging.info('GCP connection established and validated.')
         return bucket
 
+    except GCPExceptions.NotFound:
+        logging.error(
+            f'Bucket {targetBucketName} in {client.project} not found.')
+        sys.exit('Exiting due to invalid bucket name.')
+
     except GAuthExceptions.RefreshError as e:
         logging.error(f'Account Error: {e}')
         logging.error(
@@ -63,10 +81,15 @@ def makeGCPConnection(gcpParams, targetBucketName):
         sys.exit('Exiting due to failed GCP connection.')
 
 
+@functools.lru_cache(maxsize=32)
+def queryTemplateLoader(queryPath):
+    with open(queryPath) as queryFile:
+        return queryFile.read()
+
+
 def queryRetriever(queryName, queryFolder, queryModifier=False,
                    ):
-    with open(os.path.join(queryFolder, queryName)) as queryFile:
-        queryLines = ''.join(queryFile.readlines())
+    queryLines = queryTemplateLoader(os.path.join(queryFolder, queryName))
 
     if queryModifier:
         queryLines = queryLines.format(queryModifier)
@@ -91,14 +114,46 @@ def courseQueryMaker(courseQueryTemplate, monthsModifier, engine, defaultQueryFo
         sys.exit('Exiting due to failure in Course List retrieval.')
 
 
-def retrieveQueryMaker(retrieveQueryTemplate, courseIDs, engine, defaultQueryFolder):
+def nullableIDFixer(retrieveDF):
+
+    # pandas infers types per chunk, so an ID column from a LEFT JOIN is
+    # float (or all-None object) only in chunks that contain a NULL. Cast
+    # those to a nullable integer so they are written like the integer
+    # chunks. Columns that do not hold integers are left as they are.
+    for column in retrieveDF.columns:
+        if not column.endswith('ID'):
+            continue
+        columnValues = retrieveDF[column]
+        allNull = pd.api.types.is_object_dtype(columnValues) and columnValues.isna().all()
+        if not pd.api.types.is_float_dtype(columnValues) and not allNull:
+            continue
+
+        try:
+            retrieveDF[column] = columnValues.astype('Int64')
+        except (TypeError, ValueError) as e:
+            logging.warning(f'Error Message: {e}')
+            logging.warning(
+                f'Column {column} could not be written as integers and is left unchanged.')
+
+    return retrieveDF
+
+
+def retrieveQueryMaker(retrieveQueryTemplate, courseIDs, engine, defaultQueryFolder, chunkSize):
 
     try:
-        courseIDString = ','.join(map(str, courseIDs))
-        retrieveQuery = queryRetriever(
-            retrieveQueryTemplate, defaultQueryFolder, courseIDString)
-        with engine.connect() as connection:
-            retrieveDF = pd.read_sql(retrieveQuery, connection)
+        # Course IDs are bound as an expanding parameter instead of being
+        # pasted into the template, so they are always escaped by the driver.
+        retrieveQuery = sql.text(queryRetriever(
+            retrieveQueryTemplate, defaultQueryFolder)).bindparams(
+                sql.bindparam('courseIDs', expanding=True))
+        queryParams = {'courseIDs': list(courseIDs)}
+
+        # Results are streamed from a server-side cursor so slices can be
+        # uploaded while the rest of the course data is still being read.
+        with engine.execution_options(stream_results=True).connect() as connection:
+            for retrieveDF in pd.read_sql(retrieveQuery, connection, params=queryParams,
+                                          chunksize=chunkSize):
+                yield nullableIDFixer(retrieveDF)
         logging.info('Course Data retrieved...')
 
     except sql.exc.OperationalError as e:
@@ -106,31 +161,114 @@ def retrieveQueryMaker(retrieveQueryTemplate, courseIDs, engine, defaultQueryFol
         logging.error('Failed to retrieve Course Data.')
         sys.exit('Exiting due to failure in Course Data retrieval.')
 
-    return retrieveDF
 
+def uploadToGCP(bucket, outputFilename, tsvBuffer, maxAttempts=3):
 
-def sliceAndPushToGCP(courseDF, retrieveDF, bucket):
+    # Passing the size lets files up to 8 MiB (the library's multipart
+    # limit) go up in a single request; larger files use a resumable session.
+    tsvSize = tsvBuffer.seek(0, io.SEEK_END)
+
+    # Transient server-side errors, throttling and dropped connections are
+    # retried with exponential backoff. Anything else (e.g. NotFound) and
+    # the last failed attempt are raised to the caller.
+    for attempt in range(maxAttempts):
+        try:
+            blob = bucket.blob(outputFilename)
+            blob.content_encoding = 'gzip'
+            blob.upload_from_file(tsvBuffer, rewind=True, size=tsvSize,
+                                  content_type='text/tsv')
+            return
+
+        except (GCPExceptions.ServerError, GCPExceptions.TooManyRequests,
+                requests.exceptions.ConnectionError) as e:
+            if attempt == maxAttempts - 1:
+                raise
+            logging.warning(f'Error Message: {e}')
+            logging.warning(
+                f'Retrying upload of {outputFilename} in {2 ** attempt} seconds.')
+            time.sleep(2 ** attempt)
+
+
+def sliceAndPushToGCP(courseDF, retrieveChunks, bucket, uploadWorkers):
 
     allSliced, allSaved = True, True
 
-    for _, row in courseDF.iterrows():
-        (courseID, courseName) = row
-        outputFilename = f'{courseID} - {courseName}.tsv'
+    courseNames = dict(
+        zip(courseDF['id'].to_numpy(), courseDF['name'].to_numpy()))
+    courseBuffers, pushedCourseIDs = {}, set()
+
+    with ThreadPoolExecutor(max_workers=uploadWorkers) as executor:
+        uploads = {}
+
+        def pushCourse(courseID):
+            outputFilename = f'{courseID} - {courseNames[courseID]}.tsv'
+            logging.debug('Saving to GCP: %s', outputFilename)
+            courseBuffer = courseBuffers.pop(courseID)
+            tsvBuffer = courseBuffer.fileobj
+            courseBuffer.close()
+            uploads[executor.submit(
+                uploadToGCP, bucket, outputFilename, tsvBuffer)] = outputFilename
+            pushedCourseIDs.add(courseID)
+
+        for retrieveDF in retrieveChunks:
+            if retrieveDF.empty:
+                continue
+
+            # Each course is a contiguous run of rows in a chunk sorted by
+            # CourseID, so it can be sliced by position instead of a mask.
+            if not retrieveDF['CourseID'].is_monotonic_increasing:
+                retrieveDF = retrieveDF.sort_values('CourseID', kind='stable')
+            chunkCourseIDs = retrieveDF['CourseID'].to_numpy()
+            sliceCourseIDs = pd.unique(chunkCourseIDs)
+            sliceStarts = np.searchsorted(
+                chunkCourseIDs, sliceCourseIDs, side='left')
+            sliceEnds = np.searchsorted(
+                chunkCourseIDs, sliceCourseIDs, side='right')
+
+            for courseID, start, end in zip(sliceCourseIDs, sliceStarts, sliceEnds):
+                # CourseID is already in the file name, so it is not
+                # repeated on every row.
+                saveDF = retrieveDF.iloc[start:end].drop(columns='CourseID')
+                if courseID in pushedCourseIDs:
+                    logging.error(
+                        f'Course Data for {courseID} is not ordered by CourseID and was already pushed to GCP.')
+                    allSliced = False
+                    continue
+
+                if courseID not in courseBuffers:
+                    logging.debug('Slicing: %s - %s.tsv',
+                                  courseID, courseNames[courseID])
+                    # Files are stored gzip encoded; GCS decompresses them
+                    # for clients that do not accept gzip.
+                    courseBuffers[courseID] = gzip.GzipFile(
+                        fileobj=io.BytesIO(), mode='wb', compresslevel=1, mtime=0)
+                courseBuffer = courseBuffers[courseID]
+                saveDF.to_csv(courseBuffer, header=courseBuffer.tell() == 0, index=False,
+                              sep='\t', quoting=3, quotechar='', escapechar='\\')
+
+            # Course Data is ordered by CourseID, so only the last course in
+            # this chunk can continue into the next one.
+            lastCourseID = retrieveDF['CourseID'].iat[-1]
+            for courseID in [c for c in courseBuffers if c != lastCourseID]:
+                pushCourse(courseID)
+
+        for courseID in list(courseBuffers):
+            pushCourse(courseID)
+
+        uploadsSaved = 0
+        for upload in as_completed(uploads):
+            try:
+                upload.result()
+                uploadsSaved += 1
 
-        try:
-            logging.info(f'Slicing: {outputFilename}')
-            saveDF = retrieveDF[retrieveDF['CourseID'] == courseID]
-            logging.info(f'Saving to GCP: {outputFilename}')
-            blob = bucket.blob(outputFilename)
-            blob.upload_from_string(saveDF.to_csv(
-                sep='\t', quoting=3, quotechar='', escapechar='\\'), 'text/tsv')
-
-        except GCPExceptions.NotFound as e:
-            logging.error(f'Error Message: {e}')
-            logging.error(
-                f'Failed to upload Course Data for {outputFilename} to GCP.')
-            allSaved = False
-            continue
+            except (GCPExceptions.GoogleCloudError,
+                    requests.exceptions.ConnectionError) as e:
+                logging.error(f'Error Message: {e}')
+                logging.error(
+                    f'Failed to upload Course Data for {uploads[upload]} to GCP.')
+                allSaved = False
+
+    logging.info(f'Uploaded {uploadsSaved}/{len(uploads)} course files to GCP.')
 
     return allSliced, allSaved
 
@@ -140,6 +278,8 @@ class Config:
         self.logLevel = logging.INFO
         self.targetBucketName: str = 'mpr-research-data-uploads'
         self.numberOfMonths: int = 4
+        self.uploadWorkers: int = 16
+        self.retrieveChunkSize: int = 100000
         self.defaultQueryFolder: str = 'queries'
         self.queryTemplateDict: str = {'course': 'courseQuery.sql',
                                        'retrieve': 'retrieveQuery.sql'}
@@ -152,7 +292,7 @@ class Config:
 
     def set(self, name, value):
         if name in self.__dict__:
-            self.name = value
+            setattr(self, name, value)
         else:
             raise NameError('Name not accepted in set() method')
 
@@ -199,6 +339,14 @@ class Config:
             'NUMBER_OF_MONTHS', self.numberOfMonths, int, lambda x: x > 0)
         envImportSuccess = False if not self.numberOfMonths or not envImportSuccess else True
 
+        self.uploadWorkers = self.configFetch(
+            'UPLOAD_WORKERS', self.uploadWorkers, int, lambda x: x > 0)
+        envImportSuccess = False if not self.uploadWorkers or not envImportSuccess else True
+
+        self.retrieveChunkSize = self.configFetch(
+            'RETRIEVE_CHUNK_SIZE', self.retrieveChunkSize, int, lambda x: x > 0)
+        envImportSuccess = False if not self.retrieveChunkSize or not envImportSuccess else True
+
         self.defaultQueryFolder = self.configFetch(
             'QUERY_FOLDER', self.defaultQueryFolder, str, lambda x: os.path.isdir(x))
         envImportSuccess = False if not self.defaultQueryFolder or not envImportSuccess else True
@@ -237,29 +385,34 @@ def main():
     config = Config()
     config.setFromEnv()
 
-    # ESTABLISH CONNECTIONS
+    # ESTABLISH CONNECTIONS AND RETRIEVE COURSE INFO
     # --------------------------------------------------------------------------
-    sqlEngine = makeDBConnection(config.dbParams)
-    gcpBucket = makeGCPConnection(config.gcpParams, config.targetBucketName)
+    # The GCP connection does not depend on the DB, so it is set up and
+    # validated while the DB connection is made and the courses are queried.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        gcpConnection = executor.submit(
+            makeGCPConnection, config.gcpParams, config.targetBucketName,
+            config.uploadWorkers)
 
-    # RETRIEVE COURSE INFO
-    # --------------------------------------------------------------------------
-    courseQueryDF = courseQueryMaker(
-        config.queryTemplateDict['course'], config.numberOfMonths, sqlEngine, config.defaultQueryFolder)
+        sqlEngine = makeDBConnection(config.dbParams)
+        courseQueryDF = courseQueryMaker(
+            config.queryTemplateDict['course'], config.numberOfMonths, sqlEngine, config.defaultQueryFolder)
+
+        gcpBucket = gcpConnection.result()
 
     if len(courseQueryDF) == 0:
         logging.info('No courses to be retrieved.')
         sys.exit('Exiting due to no courses being found in current configuration.')
 
-    # RETRIEVE COURSE DATA
-    # --------------------------------------------------------------------------
-    retrieveQueryDF = retrieveQueryMaker(
-        config.queryTemplateDict['retrieve'], courseQueryDF['id'], sqlEngine, config.defaultQueryFolder)
-
-    # SEND TO GCP BUCKET
+    # RETRIEVE COURSE DATA AND SEND TO GCP BUCKET
     # --------------------------------------------------------------------------
-    allSliced, allSaved = sliceAndPushToGCP(courseQueryDF, retrieveQueryDF,
-                                            gcpBucket)
+    # Course Data is read in chunks; each course is uploaded as soon as all
+    # of its rows have been read.
+    retrieveQueryChunks = retrieveQueryMaker(
+        config.queryTemplateDict['retrieve'], courseQueryDF['id'], sqlEngine,
+        config.defaultQueryFolder, config.retrieveChunkSize)
+    allSliced, allSaved = sliceAndPushToGCP(courseQueryDF, retrieveQueryChunks,
+                                            gcpBucket, config.uploadWorkers)
 
     # This is because even if one course fails to save or upload
     # The code can still attempt to keep running for the other courses.
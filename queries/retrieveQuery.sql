@@ -33,8 +33,9 @@ LEFT JOIN canvas_students AS authors ON
 LEFT JOIN criteria ON
   peer_review_comments.criterion_id = criteria.id
 WHERE
-  canvas_courses.id in ({})
+  canvas_courses.id IN :courseIDs
 ORDER BY
+  canvas_courses.id,
   prompts.id,
   authors.sortable_name,
   reviewers.sortable_name,